@@ -3,11 +3,12 @@
 Manage cloud instances where metadata is defined in hiera
 
 Usage:
-  aws.py start <name> [ --config=<path> ]
-  aws.py stop <name> [ --config=<path> ]
-  aws.py toggle <name> [ --config=<path> ]
-  aws.py status [ <name> ] [ --config=<path> ]
-  aws.py check <name> [ --config=<path> ]
+  aws.py start <name> [ --config=<path> ] [ --local ]
+  aws.py stop <name> [ --config=<path> ] [ --local ]
+  aws.py toggle <name> [ --config=<path> ] [ --local ]
+  aws.py status [ <name> ] [ --config=<path> ] [ --local ]
+  aws.py check <name> [ --config=<path> ] [ --local ]
+  aws.py --daemon
   aws.py (-h | --help)
 
 Arguments:
@@ -21,6 +22,10 @@ Arguments:
 Options:
   -h --help        Display this help
   --config=<path>  Hiera config [default: /etc/puppet/hiera.yaml]
+  --local          Run in this process instead of the background daemon
+  --daemon         Serve commands on a unix socket, keeping hiera and boto3
+                   loaded between runs, started automatically when missing,
+                   one per AWS environment and credentials in use
 
 The base parameters required in hiera for a <name>:
   metadata:hostname  hostname
@@ -38,28 +43,333 @@ A metadata:provider field is also checked, if set to 'aws' also set:
 
 """
 
-from __future__ import print_function, division  # Only tested on Python 2.7 or later
-
+import io
+import os
+import re
 import sys
 import time
+import json
+import fcntl
+import hashlib
+import stat
+import signal
+import socket
+import string
+import tempfile
+import threading
+import traceback
 import subprocess
-import boto3
+import socketserver
+import contextlib
+from functools import lru_cache
 from docopt import docopt
+# yaml, boto3 and botocore are imported where they are used, the client that hands commands to the
+# daemon only needs the standard library and importing them would cost more than the daemon saves
 
 
-def hiera_get(item, variable, config='/etc/puppet/hiera.yaml'):
-    """Call external hiera binary to get a value
-    (sudo gem install -n /usr/local/bin hiera)
+# matches %{...} interpolation tokens in hiera config and data
+HIERA_TOKEN = re.compile(r'%\{([^}]*)\}')
+# a puppet var, optionally top scope like ::fqdn, dots dig into hashes like trusted.certname
+HIERA_VARIABLE = re.compile(r'^(?:::)?([A-Za-z_][\w:]*(?:\.[\w-]+)*)$')
+# an interpolation function with one quoted argument like hiera('key')
+HIERA_FUNCTION = re.compile(r'''^(\w+)\((['"])(.*)\2\)$''')
+
+
+def hiera_variable(name, scope):
+    """Look up a puppet var in the scope, unset vars become empty like in hiera
+    Arguments:
+        name  = str of var name, dots dig into hashes
+        scope = dict of puppet vars to emulate
+    Returns:
+        value = value of the var or empty str"""
+
+    parts = name.lstrip(':').split('.')
+    # facts are also top scope vars, so facts.fqdn finds fqdn when there is no facts hash
+    if parts[0] == 'facts' and len(parts) > 1 and 'facts' not in scope:
+        parts = parts[1:]
+    value = scope
+    for part in parts:
+        value = value.get(part) if isinstance(value, dict) else None
+    return '' if value is None else value
+
+
+def hiera_token(token, scope, lookup=None, whole=False):
+    """Resolve what is inside one %{} token, anything not understood is an error rather than empty
+    Arguments:
+        token  = str between the braces of the token
+        scope  = dict of puppet vars to emulate
+        lookup = function of key and scope for hiera, lookup and alias, None to refuse them (optional)
+        whole  = boolean of whether the token is the entire string, required for alias (optional)
+    Returns:
+        value  = value the token stands for"""
+
+    token = token.strip()
+    if not token:
+        return ''
+
+    match = HIERA_VARIABLE.match(token)
+    if match:
+        return hiera_variable(match.group(1), scope)
+
+    match = HIERA_FUNCTION.match(token)
+    if match:
+        function, argument = match.group(1), match.group(3)
+        if function == 'literal':
+            return argument
+        if function == 'scope':
+            return hiera_variable(argument, scope)
+        if function in ('hiera', 'lookup') or (function == 'alias' and whole):
+            if lookup is not None:
+                value = lookup(argument, scope)
+                if value is None:
+                    raise ValueError(f'hiera key {argument} used in interpolation is not set')
+                return value
+
+    raise ValueError(f'Unsupported hiera interpolation %{{{token}}}')
+
+
+def hiera_interpolate(value, scope, lookup=None):
+    """Replace hiera %{} tokens with puppet vars or looked up values, unset vars become empty like in hiera
+    Arguments:
+        value  = str, list, or dict read from hiera
+        scope  = dict of puppet vars to emulate
+        lookup = function of key and scope for hiera, lookup and alias, None to refuse them (optional)
+    Returns:
+        value  = same type as passed in with all strings interpolated"""
+
+    if isinstance(value, str):
+        # alias keeps the type of the aliased value so it can only stand alone
+        whole = HIERA_TOKEN.fullmatch(value)
+        if whole and whole.group(1).strip().startswith('alias('):
+            return hiera_token(whole.group(1), scope, lookup, whole=True)
+        return HIERA_TOKEN.sub(lambda match: hiera_format(hiera_token(match.group(1), scope, lookup)), value)
+    elif isinstance(value, list):
+        return [hiera_interpolate(item, scope, lookup) for item in value]
+    elif isinstance(value, dict):
+        return {key: hiera_interpolate(item, scope, lookup) for key, item in value.items()}
+    return value
+
+
+def hiera_format(value):
+    """Format a value from hiera as text the way the hiera binary would where it can,
+    nil for unset and lowercase booleans, but json for arrays and hashes instead of ruby inspect
+    Arguments:
+        value = value from hiera
+    Returns:
+        text  = str of value"""
+
+    if value is None:
+        return 'nil'
+    elif isinstance(value, bool):
+        return 'true' if value else 'false'
+    elif isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return str(value)
+
+
+# stamps of every hiera config and data file read so far, to notice edits in a long running process
+HIERA_STAMPS = {}
+
+
+def hiera_stamp(path):
+    """Get what identifies the current contents of a file
+    Arguments:
+        path  = str of path to file
+    Returns:
+        stamp = tuple of modification time and size, None if missing"""
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def hiera_refresh():
+    """Drop every cached hiera result if any config or data file read so far has changed
+    Arguments:
+        None
+    Returns:
+        None"""
+
+    if any(hiera_stamp(path) != stamp for path, stamp in HIERA_STAMPS.items()):
+        hiera_get.cache_clear()
+        hiera_client.cache_clear()
+        hiera_data.cache_clear()
+        HIERA_STAMPS.clear()
+
+
+@lru_cache(maxsize=None)
+def hiera_data(path, backend):
+    """Read and cache a hiera data file, missing files are empty like in hiera
+    Arguments:
+        path    = str of path to data file
+        backend = str of yaml or json for how to parse it
+    Returns:
+        data    = dict of data in file"""
+
+    import yaml
+
+    HIERA_STAMPS[path] = hiera_stamp(path)
+    try:
+        with open(path) as handle:
+            if backend == 'json':
+                return json.load(handle) or {}
+            return yaml.safe_load(handle) or {}
+    except (IOError, OSError):
+        return {}
+
+
+class HieraClient(object):
+    """Resolve hiera lookups in process by reading the yaml and json backends directly
+    (pip install pyyaml), understands hiera 3 and version 5 style configs, and refuses
+    hierarchy levels it can not read rather than skipping them
 
+    Arguments:
+        config = str of path to config file"""
+
+    # v5 level keys that locate data in ways other than a plain path
+    UNSUPPORTED_LOCATIONS = ('glob', 'globs', 'uri', 'uris', 'mapped_paths')
+    # v5 backend functions and the data file type each reads
+    BACKENDS = {('data_hash', 'yaml_data'): 'yaml', ('data_hash', 'json_data'): 'json'}
+
+    def __init__(self, config='/etc/puppet/hiera.yaml'):
+        import yaml
+
+        with open(config) as handle:
+            settings = yaml.safe_load(handle) or {}
+
+        # build the ordered list of data file templates to search, still containing %{var} tokens,
+        # each paired with the backend that parses it
+        self.sources = []
+        self.scoped = {}
+        # keys being resolved right now, to catch values that interpolate themselves
+        self.resolving = []
+        if settings.get('version') == 5:
+            defaults = settings.get('defaults') or {}
+            for level in settings.get('hierarchy') or []:
+                name = level.get('name')
+                locations = [key for key in self.UNSUPPORTED_LOCATIONS if key in level]
+                if locations:
+                    raise ValueError(f'Unsupported hiera level {name}: {", ".join(locations)}')
+                if 'paths' in level:
+                    paths = level['paths']
+                elif 'path' in level:
+                    paths = [level['path']]
+                else:
+                    raise ValueError(f'Unsupported hiera level {name}: no path or paths')
+
+                # a level names at most one backend function, otherwise the defaults apply
+                functions = [(key, level[key]) for key in ('data_hash', 'lookup_key', 'data_dig') if key in level]
+                functions = functions or [(key, defaults[key]) for key in ('data_hash', 'lookup_key', 'data_dig')
+                                          if key in defaults]
+                function = functions[0] if functions else ('data_hash', 'yaml_data')
+                if function not in self.BACKENDS:
+                    raise ValueError(f'Unsupported hiera level {name}: {function[0]} {function[1]}')
+
+                datadir = os.path.join(os.path.dirname(config), level.get('datadir', defaults.get('datadir', 'data')))
+                for path in paths:
+                    self.sources.append((os.path.join(datadir, path), self.BACKENDS[function]))
+        else:
+            backends = settings.get(':backends') or ['yaml']
+            hierarchy = settings.get(':hierarchy') or ['common']
+            if isinstance(backends, str):
+                backends = [backends]
+            if isinstance(hierarchy, str):
+                hierarchy = [hierarchy]
+            for backend in backends:
+                if backend not in ('yaml', 'json'):
+                    raise ValueError(f'Unsupported hiera backend {backend}')
+                datadir = (settings.get(':{0}'.format(backend)) or {}).get(':datadir', '/var/lib/hiera')
+                for level in hierarchy:
+                    self.sources.append((os.path.join(datadir, '{0}.{1}'.format(level, backend)), backend))
+
+    def data(self, scope):
+        """Load the data files of the hierarchy for a scope, resolved once and shared by every key
+        Arguments:
+            scope = dict of puppet vars to emulate
+        Returns:
+            data  = list of dicts of data files in priority order"""
+
+        # scopes can hold hashes like trusted, so key the cache on their json form
+        cache_key = json.dumps(scope, sort_keys=True)
+        if cache_key not in self.scoped:
+            self.scoped[cache_key] = [hiera_data(hiera_interpolate(source, scope), backend)
+                                      for source, backend in self.sources]
+        return self.scoped[cache_key]
+
+    def get(self, key, scope):
+        """Priority lookup of a key, the first level of the hierarchy holding it wins
+        Arguments:
+            key   = str of hiera data item to query for, dots walk into hashes
+            scope = dict of puppet vars to emulate
+        Returns:
+            value = value from hiera or None if not found"""
+
+        if key in self.resolving:
+            raise ValueError(f'Interpolation loop detected in hiera: {" -> ".join(self.resolving + [key])}')
+
+        first, _, rest = key.partition('.')
+        for data in self.data(scope):
+            if first not in data:
+                continue
+            value = data[first]
+            for part in rest.split('.') if rest else []:
+                value = value.get(part) if isinstance(value, dict) else None
+            self.resolving.append(key)
+            try:
+                return hiera_interpolate(value, scope, self.get)
+            finally:
+                self.resolving.pop()
+        return None
+
+
+@lru_cache(maxsize=None)
+def hiera_client(config='/etc/puppet/hiera.yaml'):
+    """Get a HieraClient, parsing each config file only once
+    Arguments:
+        config = str of path to config file
+    Returns:
+        client = HieraClient for the config"""
+
+    HIERA_STAMPS[config] = hiera_stamp(config)
+    return HieraClient(config)
+
+
+def hiera_get_many(items, variable, config='/etc/puppet/hiera.yaml'):
+    """Get several values from hiera
+    Arguments:
+        items    = list of str of hiera data items to query for
+        variable = str of puppet vars to emulate
+        config   = str of path to config file (optional)
+    Returns:
+        output   = dict of item to str of value from hiera"""
+
+    return {item: hiera_get(item, variable, config) for item in items}
+
+
+@lru_cache(maxsize=512)
+def hiera_get(item, variable, config='/etc/puppet/hiera.yaml'):
+    """Get a value from hiera formatted by hiera_format
+    repeated lookups are answered from cache for the life of the process
     Arguments:
         item     = str of hiera data item to query for
         variable = str of puppet vars to emulate
         config   = str of path to config file (optional)
     Returns:
-        output   = str of value from hiera"""
+        output   = str of value from hiera, 'nil' if unset"""
+
+    scope = dict([variable.split('=', 1)])
+    return hiera_format(hiera_client(config).get(item, scope))
 
-    return subprocess.check_output(['hiera', '-c', config, item, variable],
-                                   universal_newlines=True).strip()
+
+# parameters common to all hosting providers or platforms
+METADATA_PARAMS = ('hostname', 'domain', 'provider', 'role', 'repo')
+# parameters unique to a particular provider or platform
+METADATA_AWS_PARAMS = ('subnet', 'secgroup', 'keypair', 'ami', 'type', 'region')
+# pairs of parameter and its full hiera key, joined once here rather than on every lookup
+METADATA_KEYS = tuple((item, f'metadata:{item}') for item in METADATA_PARAMS)
+METADATA_AWS_KEYS = tuple((item, f'metadata:aws:{item}') for item in METADATA_AWS_PARAMS)
 
 
 def metadata_get(node):
@@ -71,20 +381,19 @@ def metadata_get(node):
 
     metadata = dict()
 
-    # get parameters common to all hosting providers or platforms
-    params = ['hostname', 'domain', 'provider', 'role', 'repo']
-    for item in params:
-        metadata[item] = hiera_get('metadata:{0}'.format(item), 'fqdn={0}'.format(node))
+    # query everything in one hiera call, provider specific values are only kept if they apply
+    values = hiera_get_many([key for _, key in METADATA_KEYS + METADATA_AWS_KEYS], f'fqdn={node}')
+
+    for item, key in METADATA_KEYS:
+        metadata[item] = values[key]
         # logging.debug('metadata_get  {0:<10} {1}'.format(item, metadata[item]))
 
     # build fqdn from hieradata
-    metadata['fqdn'] = '{0}.{1}'.format(metadata['hostname'], metadata['domain'])
+    metadata['fqdn'] = f"{metadata['hostname']}.{metadata['domain']}"
 
-    # get parameters unique to a particular provider or platform
     if metadata['provider'] == 'aws':
-        params = ['subnet', 'secgroup', 'keypair', 'ami', 'type', 'region']
-        for item in params:
-            metadata[item] = hiera_get('metadata:aws:{0}'.format(item), 'fqdn={0}'.format(node))
+        for item, key in METADATA_AWS_KEYS:
+            metadata[item] = values[key]
             # logging.debug('metadata_get  {0:<10} {1}'.format(item, metadata[item]))
 
     return metadata
@@ -102,21 +411,71 @@ def metadata_print(metadata):
         print('{0:<10} {1}'.format(key, metadata[key]))
 
 
-def ec2_start(resource, metadata):
-    """Start an AWS EC2 instance and configures with cloud-init and puppet
+# one boto3 session for the whole run, credentials and service models are only loaded once
+# created on first use so a broken aws setup does not stop check or --help from working
+SESSION = None
+EC2_CLIENTS = {}
+# shared by the client of every region: botocore backs off and retries throttling and transient
+# errors on its own, a larger pool for fanning out and keepalive so successive calls skip new handshakes
+EC2_CONFIG = dict(max_pool_connections=32, retries={'mode': 'adaptive', 'max_attempts': 10}, tcp_keepalive=True)
+
+
+def ec2_load(region):
+    """Create the ec2 boto3.client for a region if not already done
     Arguments:
-        resource = already open ec2 boto3.resource
-        metadata = dict of parameters required to launch instance
+        region   = str of aws region
+    Returns:
+        client   = ec2 boto3.client"""
+
+    import boto3
+    from botocore.config import Config
+
+    global SESSION
+    if SESSION is None:
+        SESSION = boto3.Session()
+    if region not in EC2_CLIENTS:
+        EC2_CLIENTS[region] = SESSION.client('ec2', region_name=region, config=Config(**EC2_CONFIG))
+    return EC2_CLIENTS[region]
+
+
+def ec2_preload(region='us-east-1'):
+    """Load the ec2 client ahead of use, errors are left for the real ec2_get call to report
+    Arguments:
+        region = str of aws region (optional)
     Returns:
         None"""
 
-    # do minimal provisioning of machine through cloud-init
-    # this installs git and bootstraps puppet to provision the rest
-    # requires recent ubuntu (14.04/16.04) or RHEL/CentOS 7
-    userdata = """#cloud-config
+    try:
+        ec2_load(region)
+    except Exception:
+        pass
+
+
+# loading the ec2 service models is a large part of a short run, main starts this early
+# so the json parsing overlaps with the hiera lookups, the models are shared by every region
+EC2_PRELOAD = threading.Thread(target=ec2_preload, daemon=True)
+
+
+def ec2_get(region):
+    """Get the ec2 boto3.client for a region, created once per run
+    Arguments:
+        region   = str of aws region
+    Returns:
+        client   = ec2 boto3.client"""
+
+    # the session is not thread safe, let any preload finish before using it
+    if EC2_PRELOAD.is_alive():
+        EC2_PRELOAD.join()
+    return ec2_load(region)
+
+
+# do minimal provisioning of machine through cloud-init
+# this installs git and bootstraps puppet to provision the rest
+# requires recent ubuntu (14.04/16.04) or RHEL/CentOS 7
+USERDATA = string.Template("""#cloud-config
 package_update: true
-hostname: {hostname}
-fqdn: {fqdn}
+hostname: $hostname
+fqdn: $fqdn
 manage_etc_hosts: true
 packages:
   - git
@@ -124,14 +483,25 @@ write_files:
   - path: /etc/facter/facts.d/hostgroup.txt
     content: hostgroup=aws
   - path: /etc/facter/facts.d/role.txt
-    content: role={role}
+    content: role=$role
 runcmd:
-  - git clone {repo} /etc/puppet
-  - /etc/puppet/support_scripts/bootstrap-puppet.sh""".format(
-      hostname=metadata['hostname'], fqdn=metadata['fqdn'],
-      role=metadata['role'], repo=metadata['repo'])
+  - git clone $repo /etc/puppet
+  - /etc/puppet/support_scripts/bootstrap-puppet.sh""")
+
+
+def ec2_start(client, metadata):
+    """Start an AWS EC2 instance and configures with cloud-init and puppet
+    Arguments:
+        client   = already open ec2 boto3.client
+        metadata = dict of parameters required to launch instance
+    Returns:
+        None"""
+
+    userdata = USERDATA.substitute(
+        hostname=metadata['hostname'], fqdn=metadata['fqdn'],
+        role=metadata['role'], repo=metadata['repo'])
 
-    instances = resource.create_instances(
+    response = client.run_instances(
         ImageId=metadata['ami'],
         MinCount=1,
         MaxCount=1,
@@ -152,86 +522,157 @@ runcmd:
         ]
     )
 
-    # not sure if we really need to sleep before tagging but
-    # we wait until running anyway which takes much longer than 1 second
-    time.sleep(1)
-    for instance in instances:
-        # first set tags, Name and Role
-        instance.create_tags(
-            Resources=[instance.id],
-            Tags=[
-                {
-                    'Key': 'Role',
-                    'Value': metadata['role']
-                },
-                {
-                    'Key': 'Name',
-                    'Value': metadata['fqdn']
-                },
-            ]
-        )
+    ids = [instance['InstanceId'] for instance in response['Instances']]
+
+    # first set tags, Name and Role, on every new instance in one call
+    ec2_tag(client, ids, [
+        {
+            'Key': 'Role',
+            'Value': metadata['role']
+        },
+        {
+            'Key': 'Name',
+            'Value': metadata['fqdn']
+        },
+    ])
+
+    # ensure systems are running before we print address to connect to
+    # a single waiter polls for every instance at once instead of waiting on each in turn
+    client.get_waiter('instance_running').wait(
+        InstanceIds=ids,
+        WaiterConfig={'Delay': 15, 'MaxAttempts': 40})
+    # describe just the new ids for their addresses rather than searching by name again
+    ec2_print(list(ec2_describe(client, ids=ids)))
+
+
+def ec2_tag(client, ids, tags, attempts=5):
+    """Tag instances, tolerating the short window where new ids are not yet visible
+    Arguments:
+        client   = already open ec2 boto3.client
+        ids      = list of str of instance ids to tag
+        tags     = list of dicts of Key and Value to set
+        attempts = int of times to try before giving up (optional)
+    Returns:
+        None"""
+
+    from botocore.exceptions import ClientError
 
-        # ensure system is running before we print address to connect to
-        instance.wait_until_running()
-        # instance.load()
-        ec2_status(resource, metadata)
+    # botocore retries do not cover InvalidInstanceID.NotFound from eventual consistency
+    # so back off here, usually the first call already succeeds and nothing waits
+    for attempt in range(attempts):
+        try:
+            client.create_tags(Resources=ids, Tags=tags)
+            return
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'InvalidInstanceID.NotFound' or attempt == attempts - 1:
+                raise
+            time.sleep(0.5 * 2 ** attempt)
 
 
-def ec2_stop(resource, metadata):
-    """Stop and terminate an AWS EC2 instance
+def ec2_stop(client, metadata, instances=None):
+    """Terminate AWS EC2 instances matching a name
     Arguments:
-        resource = already open ec2 boto3.resource
-        instance_id = id of instance to terminate
+        client    = already open ec2 boto3.client
+        metadata  = dict containing key fqdn with value to filter on
+        instances = list of dicts of instance descriptions already found (optional)
     Returns:
         None"""
-    instances = resource.instances.filter(
-        Filters=[{'Name': 'instance-state-name', 'Values': ['running']},
-                 {'Name': 'tag:Name', 'Values': [metadata['fqdn']]}, ])
 
+    if instances is None:
+        instances = ec2_describe(client, [{'Name': 'instance-state-name', 'Values': ['running']},
+                                          {'Name': 'tag:Name', 'Values': [metadata['fqdn']]}, ])
+
+    ids = []
     for instance in instances:
-        print("Terminating vm id {0} name {1}".format(instance.id, instance.tags[0]['Value']))
-        # resource.instances.filter(InstanceIds=[instance.id]).stop()
-        resource.instances.filter(InstanceIds=[instance.id]).terminate()
+        print("Terminating vm id {0} name {1}".format(instance['InstanceId'], ec2_tags(instance)['Name']))
+        ids.append(instance['InstanceId'])
+
+    # terminate works from any state so no need to stop first, and one call covers every instance
+    if ids:
+        client.terminate_instances(InstanceIds=ids)
 
 
-def ec2_status(resource, metadata, return_count=False):
-    """Get the status of running instances
+def ec2_describe(client, filters=None, ids=None):
+    """Describe instances with server side filters, paging through the full result set
     Arguments:
-        resource     = already open ec2 boto3.resource
-        metadata     = dict containing key fqdn with value to filter on
-        return_count = boolean option to return count or not
+        client    = already open ec2 boto3.client
+        filters   = list of dicts of ec2 filters (optional)
+        ids       = list of str of instance ids to describe instead of filtering (optional)
+    Yields:
+        instance  = dict of instance description from describe_instances"""
+
+    paginator = client.get_paginator('describe_instances')
+    if ids is not None:
+        # an empty id list is a caller bug, never let it widen into every instance in the region
+        if not ids:
+            return
+        # page size can not be combined with explicit ids, they come back in one response anyway
+        pages = paginator.paginate(InstanceIds=ids)
+    elif filters:
+        pages = paginator.paginate(Filters=filters, PaginationConfig={'PageSize': 1000})
+    else:
+        raise ValueError('ec2_describe needs filters or ids, refusing to describe every instance')
+    for page in pages:
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                yield instance
+
+
+def ec2_tags(instance):
+    """Map the tags of an instance description to a dict
+    Arguments:
+        instance = dict of instance description from describe_instances
+    Returns:
+        tags     = dict of tag key to tag value"""
+
+    # tags order does not deterministically stay from run to run and stored as list of dicts
+    return {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+
+
+def ec2_filters(metadata):
+    """Build the describe filters matching pending or running instances by name
+    Arguments:
+        metadata = dict containing key fqdn with value to filter on, '*' for all instances
     Returns:
-        None or count = int of number of running instances"""
+        filters  = list of dicts of ec2 filters"""
 
-    instances = resource.instances.filter(
-        Filters=[{'Name': 'tag:Name', 'Values': [metadata['fqdn']]},
-                 {'Name': 'instance-state-name', 'Values': ['pending', 'running']}, ])
+    filters = [{'Name': 'instance-state-name', 'Values': ['pending', 'running']}, ]
+    # a wildcard name filter would still skip instances without a Name tag, so leave it off for all
+    if metadata['fqdn'] != '*':
+        filters.append({'Name': 'tag:Name', 'Values': [metadata['fqdn']]})
+    return filters
+
+
+def ec2_status(client, metadata):
+    """Print the status of running instances
+    Arguments:
+        client   = already open ec2 boto3.client
+        metadata = dict containing key fqdn with value to filter on
+    Returns:
+        None"""
+
+    ec2_print(list(ec2_describe(client, ec2_filters(metadata))))
+
+
+def ec2_print(instances):
+    """Print name, role, and public IP of already described instances
+    Arguments:
+        instances = list of dicts of instance descriptions
+    Returns:
+        None"""
 
-    # get a count of the instances and then either return count or print results
-    count = sum(1 for _ in instances)
-    if return_count:
-        # return count for conditional consumption in other functions
-        return count
+    # print for human consumption
+    if not instances:
+        print("No instances running")
     else:
-        # print for human consumption
-        if count == 0:
-            print("No instances running")
-        else:
-            print(count, "instances running")
+        print(len(instances), "instances running")
+        print('{:20} {:15} {:22} {:18} {}'.format(
+            'instance_id', 'state', 'instance_name', 'public_ip_address', 'instance_role'))
+        for instance in instances:
+            tags = ec2_tags(instance)
             print('{:20} {:15} {:22} {:18} {}'.format(
-                'instance_id', 'state', 'instance_name', 'public_ip_address', 'instance_role'))
-            for instance in instances:
-                # tags order does not deterministically stay from run to run and stored as list of dicts
-                # tags = {instance.tags[0]['Key']: instance.tags[0]['Value'],
-                #        instance.tags[1]['Key']: instance.tags[1]['Value']}
-                # probably there is a much better way to map this but let's make it a dict of tags
-                tags = {}
-                for tag in instance.tags:
-                    tags[tag['Key']] = tag['Value']
-
-                print('{:20} {:15} {:22} {:18} {}'.format(
-                    instance.id, instance.state['Name'], tags['Name'],
-                    instance.public_ip_address, tags['Role']))
+                instance['InstanceId'], instance['State']['Name'], tags.get('Name', ''),
+                str(instance.get('PublicIpAddress')), tags.get('Role', '')))
 
 
 def main(arguments):
@@ -244,6 +685,10 @@ def main(arguments):
     # set up logging
     # logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
 
+    # everything but check talks to ec2, warm up boto3 while hiera is read
+    if not arguments['check'] and EC2_PRELOAD.ident is None:
+        EC2_PRELOAD.start()
+
     # pull the setup data from hiera based on the node identifier given
     # hiera will return nil for unset variables that were queried, set some safe defaults
     metadata = metadata_get(arguments['<name>'])
@@ -261,24 +706,27 @@ def main(arguments):
         # status has only an optional filter, so if we get here without a name print all
         if arguments['<name>'] is None or metadata['hostname'] == 'nil':
             metadata['fqdn'] = '*'
-        resource = boto3.resource('ec2', region_name=metadata['region'])
-        ec2_status(resource, metadata)
+        client = ec2_get(metadata['region'])
+        ec2_status(client, metadata)
 
     elif metadata['provider'] == 'aws':
         # make connection to ec2 and then perform actions
-        resource = boto3.resource('ec2', region_name=metadata['region'])
+        client = ec2_get(metadata['region'])
 
         if arguments['start']:
-            ec2_start(resource, metadata)
+            ec2_start(client, metadata)
         elif arguments['stop']:
-            ec2_stop(resource, metadata)
+            ec2_stop(client, metadata)
         elif arguments['toggle']:
             # we either start or stop to go to inverse of the current state
-            count = ec2_status(resource, metadata, return_count=True)
-            if count == 0:
-                ec2_start(resource, metadata)
+            # the instances found here are handed to stop so they are not described twice,
+            # narrowed to running ones since stop on its own leaves pending instances alone
+            instances = list(ec2_describe(client, ec2_filters(metadata)))
+            if not instances:
+                ec2_start(client, metadata)
             else:
-                ec2_stop(resource, metadata)
+                ec2_stop(client, metadata, [instance for instance in instances
+                                            if instance['State']['Name'] == 'running'])
 
     elif metadata['provider'] == 'do':
         print("Digitalocean not yet supported")
@@ -289,5 +737,252 @@ def main(arguments):
         sys.exit(1)
 
 
+# seconds without a command before the daemon exits on its own
+DAEMON_IDLE = 900
+# seconds a connection may stall on the socket before the daemon drops it and moves on
+DAEMON_TIMEOUT = 10
+
+
+def daemon_dir():
+    """Get the private directory for the daemon socket, creating it if needed
+    Arguments:
+        None
+    Returns:
+        path = str of path to directory, None if it is not safe to use"""
+
+    path = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(), f'cloudtools-{os.getuid()}')
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    except OSError:
+        return None
+
+    # in a shared temp dir another user could have made it first, only trust our own private dir
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        return None
+    return path
+
+
+# environment that changes which account, credentials or endpoints a command would act with
+DAEMON_ENVIRONMENT = ('HOME', 'HTTP_PROXY', 'HTTPS_PROXY', 'NO_PROXY', 'http_proxy', 'https_proxy', 'no_proxy',
+                      'REQUESTS_CA_BUNDLE', 'SSL_CERT_FILE', 'SSL_CERT_DIR')
+
+
+def daemon_identity():
+    """Fingerprint what a command inherits from its environment, a daemon only serves callers that match
+    Arguments:
+        None
+    Returns:
+        identity = str of hex digest of aws environment, credential files and this script"""
+
+    environment = sorted((key, value) for key, value in os.environ.items()
+                         if key.startswith(('AWS_', 'BOTO')) or key in DAEMON_ENVIRONMENT)
+    # credentials can also change on disk under the same environment
+    aws_dir = os.path.join(os.path.expanduser('~'), '.aws')
+    files = [os.environ.get('AWS_CONFIG_FILE', os.path.join(aws_dir, 'config')),
+             os.environ.get('AWS_SHARED_CREDENTIALS_FILE', os.path.join(aws_dir, 'credentials'))]
+    stamps = [(path, hiera_stamp(path)) for path in files]
+    script = (sys.executable, os.path.abspath(__file__), hiera_stamp(os.path.abspath(__file__)))
+    return hashlib.sha256(json.dumps([environment, stamps, script]).encode()).hexdigest()
+
+
+def daemon_socket(identity):
+    """Get the path of the daemon socket for an identity
+    Arguments:
+        identity = str of fingerprint from daemon_identity
+    Returns:
+        path     = str of path to unix socket, None if there is no safe place for it"""
+
+    directory = daemon_dir()
+    return os.path.join(directory, f'daemon-{identity[:32]}.sock') if directory else None
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """Run one command sent by daemon_call through main and send back what it printed"""
+
+    # applied to the socket in setup, so a silent connection can not block every later command
+    timeout = DAEMON_TIMEOUT
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except (OSError, ValueError):
+            return
+
+        # the socket name already matches the identity, this guards against anything that slipped through
+        # and a refused caller runs the command itself
+        refused = request.get('identity') != self.server.identity
+        if not refused:
+            try:
+                os.chdir(request['cwd'])
+            except OSError:
+                refused = True
+        if refused:
+            self.wfile.write(json.dumps({'refused': True}).encode() + b'\n')
+            return
+        arguments = request['arguments']
+
+        # hiera data may have been edited since the last command, only then start hiera over
+        hiera_refresh()
+
+        output, errors, status = io.StringIO(), io.StringIO(), 0
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(errors):
+            try:
+                main(arguments)
+            except SystemExit as error:
+                # same as the interpreter: no code is success, a message is printed and fails
+                if error.code is None:
+                    status = 0
+                elif isinstance(error.code, int):
+                    status = error.code
+                else:
+                    print(error.code, file=sys.stderr)
+                    status = 1
+            except Exception:
+                status = 1
+                print(traceback.format_exc(), end='', file=sys.stderr)
+        self.wfile.write(json.dumps({'output': output.getvalue(), 'errors': errors.getvalue(),
+                                     'status': status}).encode() + b'\n')
+
+
+class DaemonServer(socketserver.UnixStreamServer):
+    """Serve commands one at a time, stdout is captured process wide so they can not overlap"""
+
+    timeout = DAEMON_IDLE
+    idle = False
+    identity = None
+
+    def handle_timeout(self):
+        self.idle = True
+
+
+def daemon_serve(path=None):
+    """Keep hiera and boto3 loaded and serve commands until idle
+    Arguments:
+        path = str of path to unix socket to listen on (optional)
+    Returns:
+        None"""
+
+    identity = daemon_identity()
+    path = path or daemon_socket(identity)
+    if path is None:
+        print("No private directory for the daemon socket", file=sys.stderr)
+        sys.exit(1)
+
+    os.umask(0o077)
+    # two clients can start daemons at the same time, only the one holding the lock serves
+    lock_path = f'{path}.lock'
+    while True:
+        lock = open(lock_path, 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return
+        # an exiting daemon removes its lock file, if that happened between open and flock try the new one
+        try:
+            if os.stat(lock_path).st_ino == os.fstat(lock.fileno()).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+    # with the lock held no other daemon owns the socket, so anything left there is stale
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    # exit through the finally below on a plain kill so the socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    EC2_PRELOAD.start()
+
+    server = DaemonServer(path, DaemonHandler)
+    server.identity = identity
+    inode = os.stat(path).st_ino
+    try:
+        while not server.idle:
+            server.handle_request()
+    finally:
+        server.server_close()
+        # only remove the socket this daemon bound, never one that replaced it
+        try:
+            if os.stat(path).st_ino == inode:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+        # remove the lock file while still holding it so lock files do not pile up per identity
+        try:
+            os.unlink(lock_path)
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+
+def daemon_call(arguments, path=None, attempts=50):
+    """Run a command through the daemon for this environment, starting it in the background if not running
+    Arguments:
+        arguments = dict of docopt options
+        path      = str of path to unix socket of the daemon (optional)
+        attempts  = int of times to try connecting while the daemon starts (optional)
+    Returns:
+        status    = int of exit status of the command, None if the daemon could not be reached"""
+
+    identity = daemon_identity()
+    path = path or daemon_socket(identity)
+    if path is None:
+        return None
+
+    daemon = None
+    for attempt in range(attempts):
+        # a daemon that exited with an error will not come up, a clean exit lost the start race to another
+        if daemon is not None and daemon.poll() not in (None, 0):
+            return None
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # never hand a command to a socket some other user put there
+            if os.stat(path).st_uid != os.getuid():
+                connection.close()
+                return None
+            connection.connect(path)
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            connection.close()
+            if daemon is None:
+                daemon = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--daemon'],
+                                          stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                          stderr=subprocess.DEVNULL, start_new_session=True)
+            time.sleep(0.1)
+    else:
+        return None
+
+    with connection, connection.makefile('rb') as reply:
+        request = {'arguments': arguments, 'identity': identity, 'cwd': os.getcwd()}
+        connection.sendall(json.dumps(request).encode() + b'\n')
+        line = reply.readline()
+    if not line:
+        # the command may already have acted, so do not run it a second time here
+        print("Daemon closed the connection without a reply", file=sys.stderr)
+        return 1
+    response = json.loads(line)
+    if response.get('refused'):
+        return None
+    print(response['output'], end='')
+    print(response['errors'], end='', file=sys.stderr)
+    return response['status']
+
+
 if __name__ == "__main__":
-    main(docopt(__doc__))
+    arguments = docopt(__doc__)
+    if arguments['--daemon']:
+        daemon_serve()
+    elif arguments['--local']:
+        main(arguments)
+    else:
+        # fall back to running here if the daemon never came up
+        status = daemon_call(arguments)
+        if status is None:
+            main(arguments)
+        else:
+            sys.exit(status)